@@ -1,10 +1,21 @@
 import os
+import asyncio
 import gradio as gr
 import tempfile
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from datetime import datetime, timedelta
-from pydub import AudioSegment
+import functools
+import glob
+import hashlib
 import math
+import re
+import shelve
+import shutil
+import subprocess
+import threading
+import time
+import wave
 
 # Configure Google API
 genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
@@ -30,13 +41,8 @@ You are a professional news transcription model with the following directives:
 9. Avoid generating placeholder or filler content
 """
 
-model = genai.GenerativeModel(
-    model_name="gemini-2.0-flash",
-    generation_config=generation_config,
-    system_instruction=system_instruction,
-)
-
-# Configure safety settings to be more permissive
+# Configure safety settings to be more permissive, set once on the model
+# rather than passed with every request
 safety_settings = [
     {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
     {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
@@ -44,60 +50,251 @@ safety_settings = [
     {"category": "HARM_CATEGORY_DANGEROUS", "threshold": "BLOCK_NONE"},
 ]
 
-def split_audio(file_path, segment_duration=300000):  # 300000ms = 5 minutes
-    """Split audio file into segments"""
-    audio = AudioSegment.from_file(file_path)
-    length_ms = len(audio)
-    segments = []
+model = genai.GenerativeModel(
+    model_name="gemini-2.0-flash",
+    generation_config=generation_config,
+    system_instruction=system_instruction,
+    safety_settings=safety_settings,
+)
+
+# Number of segments sent to Gemini concurrently, keep within the API rate limit
+MAX_WORKERS = int(os.getenv('GEMINI_MAX_WORKERS', '4'))
+# Number of attempts for a request that hits the rate limit (HTTP 429)
+MAX_RETRIES = 5
+# Number of segments transcribed together in a single Gemini request, two
+# 5 minute segments keep a dense transcript within max_output_tokens
+BATCH_SIZE = int(os.getenv('GEMINI_BATCH_SIZE', '2'))
+
+# Prompt for a batch of segments, filled in by get_batch_prompt
+BATCH_PROMPT_TEMPLATE = (
+    "Generate a transcript for each of the {count} audio segments, "
+    "in the order they are given. Begin the transcript of each segment "
+    "with its header line, exactly as listed here:\n"
+    "{headers}\n"
+    "Use the format [MM:SS] for timestamps, counting from the offset in "
+    "the segment header. Add timestamps every 3-5 seconds. "
+    "Format each line as: [MM:SS] Text content. "
+    "Only transcribe actual speech - do not generate placeholder content. "
+    "If there is silence or no clear speech, skip that section. "
+    "Each transcribed line must contain meaningful content."
+)
+
+# Header line Gemini writes before each segment of a batched transcript, the
+# whole line is matched so markdown around the header is dropped with it
+SEGMENT_HEADER_RE = re.compile(
+    r'^[^\n]*?\bSEGMENT\b[^\n]*?\boffset\s*[=:]\s*(\d+):(\d+)[^\n]*$',
+    re.MULTILINE | re.IGNORECASE
+)
+
+# RAM backed (tmpfs) scratch directory for audio segments, used when they fit
+RAM_SEGMENT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+# Segments are at most as large as the input file or its duration at the
+# bitrate of the re-encoding fallback, whichever is bigger
+FALLBACK_BITRATE = 32000  # bits per second
+
+# Audio formats that can be cut without re-encoding, mapped to the segment
+# extension and the MIME type Gemini accepts for it
+STREAM_COPY_FORMATS = {
+    '.mp3': ('.mp3', 'audio/mp3'),
+    '.wav': ('.wav', 'audio/wav'),
+    '.flac': ('.flac', 'audio/flac'),
+    '.ogg': ('.ogg', 'audio/ogg'),
+    '.aac': ('.aac', 'audio/aac'),
+    '.m4a': ('.aac', 'audio/aac'),  # AAC stream taken out of its MP4 container
+}
+
+# Transcript line of the form "[MM:SS] Text content"
+TIMESTAMP_LINE_RE = re.compile(r'\[(\d{1,3}):(\d{2})\][ \t]*(.*)')
+SRT_TIMESTAMP_FORMAT = "%02d:%02d:%02d,000"
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Cache transcripts of already seen segments, set CACHE_ENABLED=0 to disable
+CACHE_ENABLED = os.getenv('CACHE_ENABLED', '1') != '0'
+CACHE_PATH = os.path.join('output', '.trcache')
+CACHE_TTL = int(os.getenv('CACHE_TTL', str(7 * 24 * 3600)))  # seconds
+# Least recently used entries beyond this are evicted
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '1000'))
+# Everything besides the audio that shapes a transcript, so that editing the
+# prompt or the model settings invalidates cached transcripts
+CACHE_FINGERPRINT = hashlib.sha256(repr((
+    model.model_name,
+    system_instruction,
+    sorted(generation_config.items()),
+    BATCH_PROMPT_TEMPLATE,
+)).encode('utf-8')).hexdigest()
+cache_stats = {'hits': 0, 'misses': 0}
+# Transcript cache lookups run in worker threads, one at a time
+cache_lock = threading.Lock()
+
+# Reuse files uploaded to Gemini, which keeps them for 48 hours
+UPLOAD_CACHE_PATH = os.path.join('output', '.upload_cache')
+UPLOAD_TTL = 47 * 3600  # seconds, an hour short of the expiry on Gemini's side
+UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv('UPLOAD_CACHE_MAX_ENTRIES', '1000'))
+upload_cache_lock = threading.Lock()
+# Uploaded files belong to the API key's project, so the key is part of every
+# upload cache key (hashed, the key itself is never written to disk)
+UPLOAD_CACHE_OWNER = hashlib.sha256(
+    os.getenv('GOOGLE_API_KEY', '').encode('utf-8')
+).hexdigest()
+
+def hash_file(path):
+    """Compute the sha256 of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_duration_ms(file_path):
+    """Read the duration of an audio file from its metadata, without decoding it"""
+    try:
+        output = subprocess.check_output([
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', file_path,
+        ])
+        return int(float(output) * 1000)
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        # ffprobe missing or unable to read the file, split it the normal way
+        return None
+
+def get_segment_dir(file_path):
+    """Pick the scratch directory for a file's segments, RAM backed when all of
+    them are sure to fit there and on disk otherwise"""
+    if RAM_SEGMENT_DIR is None:
+        return tempfile.gettempdir()
     
-    # Calculate number of segments
-    num_segments = math.ceil(length_ms / segment_duration)
+    length_ms = get_duration_ms(file_path)
+    if length_ms is None:
+        return tempfile.gettempdir()
     
-    for i in range(num_segments):
-        start = i * segment_duration
-        end = min((i + 1) * segment_duration, length_ms)
-        
-        # Extract segment
-        segment = audio[start:end]
-        
-        # Save segment to temporary file
-        temp_path = os.path.join('output', f'temp_segment_{i}.mp3')
-        segment.export(temp_path, format='mp3')
+    needed = max(os.path.getsize(file_path), length_ms * FALLBACK_BITRATE // 8000)
+    # Keep half of the space free for concurrent requests
+    if needed * 2 < shutil.disk_usage(RAM_SEGMENT_DIR).free:
+        return RAM_SEGMENT_DIR
+    return tempfile.gettempdir()
+
+def split_wav(file_path, segment_dir, segment_duration):
+    """Split a PCM WAV file into segments by copying its frames, without ffmpeg"""
+    with wave.open(file_path, 'rb') as source:
+        params = source.getparams()
+        frames_per_segment = params.framerate * segment_duration // 1000
+        for i in range(math.ceil(params.nframes / frames_per_segment)):
+            temp_path = os.path.join(segment_dir, f'temp_segment_{i:03d}.wav')
+            with wave.open(temp_path, 'wb') as segment:
+                segment.setparams(params)
+                segment.writeframes(source.readframes(frames_per_segment))
+
+def split_audio(file_path, segment_dir, segment_duration=300000):  # 300000ms = 5 minutes
+    """Split audio file into segments in segment_dir with ffmpeg, without encoding it"""
+    ext = os.path.splitext(file_path)[1].lower()
+    segment_ext, mime_type = STREAM_COPY_FORMATS.get(ext, (None, None))
+    
+    # A file that fits in one segment and that Gemini accepts as is needs no
+    # splitting at all
+    length_ms = get_duration_ms(file_path)
+    if (length_ms is not None and segment_ext == ext
+            and math.ceil(length_ms / segment_duration) <= 1):
+        return [{
+            'path': file_path,
+            'start_time': 0,
+            'prompt': get_segment_prompt(0),
+            'mime_type': mime_type,
+            'hash': hash_file(file_path),
+            'temporary': False  # The uploaded file itself, never delete it
+        }]
+    
+    command = [
+        'ffmpeg', '-y', '-v', 'error', '-i', file_path, '-vn',
+        '-f', 'segment', '-segment_time', str(segment_duration / 1000),
+        '-reset_timestamps', '1',
+    ]
+    
+    if segment_ext is not None:
+        try:
+            # Cut the stream as is, no decoding or encoding involved
+            if segment_ext == '.wav':
+                split_wav(file_path, segment_dir, segment_duration)
+            else:
+                subprocess.run(
+                    command + [
+                        '-c', 'copy',
+                        os.path.join(segment_dir, f'temp_segment_%03d{segment_ext}'),
+                    ],
+                    check=True
+                )
+        except (subprocess.CalledProcessError, wave.Error, EOFError):
+            for path in glob.glob(os.path.join(segment_dir, 'temp_segment_*')):
+                os.remove(path)
+            segment_ext = None
+    
+    if segment_ext is None:
+        # The stream can't be cut as is, re-encode it to 16 kHz mono Opus,
+        # the resolution Gemini processes audio at. Opus is a cheap encode and
+        # keeps uploads an eighth the size of PCM WAV
+        segment_ext, mime_type = '.ogg', 'audio/ogg'
+        subprocess.run(
+            command + [
+                '-c:a', 'libopus', '-b:a', str(FALLBACK_BITRATE),
+                '-ac', '1', '-ar', '16000',
+                os.path.join(segment_dir, f'temp_segment_%03d{segment_ext}'),
+            ],
+            check=True
+        )
+    
+    # Segments all have the same duration, so start times and prompts only
+    # depend on the segment index and are computed here once
+    segments = []
+    segment_seconds = segment_duration // 1000
+    paths = sorted(glob.glob(os.path.join(segment_dir, f'temp_segment_*{segment_ext}')))
+    for i, temp_path in enumerate(paths):
+        start_time = i * segment_seconds
         segments.append({
             'path': temp_path,
-            'start_time': start // 1000  # Convert to seconds
+            'start_time': start_time,
+            'prompt': get_segment_prompt(start_time),
+            'mime_type': mime_type,
+            'hash': hash_file(temp_path),
+            'temporary': True
         })
     
     return segments
 
+@functools.lru_cache(maxsize=128)
 def get_segment_prompt(start_time):
-    """Generate prompt for a segment"""
-    minutes = start_time // 60
-    return (
-        "Generate a transcript for this audio segment. "
-        "Use the format [MM:SS] for timestamps, starting from "
-        f"minute {minutes}. Add timestamps every 3-5 seconds. "
-        "Format each line as: [MM:SS] Text content. "
-        "Only transcribe actual speech - do not generate placeholder content. "
-        "If there is silence or no clear speech, skip that section. "
-        "Each transcribed line must contain meaningful content."
-    )
+    """Generate the header line identifying a segment in a batched prompt"""
+    minutes, seconds = divmod(start_time, 60)
+    return f"### SEGMENT offset={minutes:02d}:{seconds:02d}"
 
-def parse_timestamp(timestamp_str):
-    """Parse timestamp string into seconds"""
-    try:
-        mm, ss = map(int, timestamp_str.strip('[]').split(':'))
-        return mm * 60 + ss
-    except:
+def get_batch_prompt(batch):
+    """Generate prompt for a batch of consecutive segments"""
+    headers = "\n".join(segment['prompt'] for segment in batch)
+    return BATCH_PROMPT_TEMPLATE.format(count=len(batch), headers=headers)
+
+def split_batch_response(text, batch):
+    """Split a batched transcript into one transcript per segment, returning
+    None when its headers don't match the segments of the batch"""
+    parts = SEGMENT_HEADER_RE.split(text)
+    if len(parts) == 1:
+        # No headers, only usable when the batch holds a single segment
+        return [text] if len(batch) == 1 else None
+    
+    # parts is [preamble, mm, ss, body, mm, ss, body, ...]
+    transcripts = {}
+    for i in range(1, len(parts), 3):
+        start_time = int(parts[i]) * 60 + int(parts[i + 1])
+        transcripts.setdefault(start_time, []).append(parts[i + 2].strip())
+    if transcripts.keys() != {segment['start_time'] for segment in batch}:
         return None
+    return ["\n".join(transcripts[segment['start_time']]) for segment in batch]
 
+@functools.lru_cache(maxsize=4096)
 def format_srt_timestamp(seconds):
     """Convert seconds to SRT timestamp format"""
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    secs = seconds % 60
-    return f"{hours:02d}:{minutes:02d}:{secs:02d},000"
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return SRT_TIMESTAMP_FORMAT % (hours, minutes, secs)
 
+@functools.lru_cache(maxsize=4096)
 def detect_repetition_pattern(text):
     """Detect if text shows signs of hallucination through repetition patterns"""
     if not text:
@@ -115,15 +312,23 @@ def detect_repetition_pattern(text):
         if len(set(words)) == 1:
             return True
         
-        # Check for repeating pairs/triplets
-        if len(words) > 4:
-            word_pairs = [' '.join(words[i:i+2]) for i in range(0, len(words)-1)]
-            if len(set(word_pairs)) == 1:
+        # Check for a distinct word pair repeated at least three times and
+        # nothing else (e.g. "a b a b a b"), stopping at the first mismatch
+        if len(words) >= 6 and len(words) % 2 == 0:
+            w0, w1 = words[0], words[1]
+            if w0 != w1 and all(
+                words[i] == w0 and words[i+1] == w1 for i in range(0, len(words), 2)
+            ):
                 return True
     
     return False
 
-def is_valid_text(text, seen_texts, last_text):
+def normalize_text(text):
+    """Normalize text so that case, spacing and trailing punctuation variants
+    of the same line compare equal"""
+    return WHITESPACE_RE.sub(' ', text).strip().lower().rstrip('.,!?;:')
+
+def is_valid_text(text, key, seen_texts, last_text):
     # Skip empty text
     if not text:
         return False
@@ -132,8 +337,8 @@ def is_valid_text(text, seen_texts, last_text):
     if detect_repetition_pattern(text):
         return False
     
-    # Skip repeated content
-    if text in seen_texts:
+    # Skip repeated content, including near-duplicates
+    if key in seen_texts:
         return False
         
     # Skip consecutive duplicates
@@ -142,96 +347,318 @@ def is_valid_text(text, seen_texts, last_text):
     
     return True
 
-def format_srt(timestamps_text):
-    """Convert timestamp-text pairs into SRT format"""
-    entries = []
-    seen_timestamps = set()
+def format_srt_iter(timestamps_text):
+    """Convert timestamp-text pairs into SRT format, yielding one entry at a time"""
     seen_texts = set()
     current_entry = 1
     last_end_time = 0
     last_text = ""
     
-    for line in timestamps_text.split('\n'):
-        if not line.strip() or '[' not in line:
+    # Scan the whole transcript at once, lines without a timestamp are skipped
+    # without ever being split out
+    for match in TIMESTAMP_LINE_RE.finditer(timestamps_text):
+        text = match[3].strip()
+        key = normalize_text(text)
+        
+        # Validate text content
+        if not is_valid_text(text, key, seen_texts, last_text):
             continue
         
+        # Convert timestamp to seconds
+        start_time = int(match[1]) * 60 + int(match[2])
+        
+        # Ensure timestamps don't overlap and have minimum gap, this also
+        # spaces out repeated timestamps since last_end_time only grows
+        start_time = max(start_time, last_end_time + 1)  # Add 1 second gap
+        end_time = start_time + 3  # 3 second segments
+        
+        # Format timestamps
+        start_stamp = format_srt_timestamp(start_time)
+        end_stamp = format_srt_timestamp(end_time)
+        
+        # Emit entry
+        yield f"{current_entry}\n{start_stamp} --> {end_stamp}\n{text}\n\n"
+        seen_texts.add(key)
+        current_entry += 1
+        last_end_time = end_time
+        last_text = text
+
+def get_retry_delay(error, default):
+    """Read the Retry-After header from a rate limit error, if any"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After', default))
+    except (TypeError, ValueError):
+        return default
+
+async def generate_with_backoff(contents):
+    """Call Gemini, backing off exponentially while rate limited"""
+    delay = 1
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await model.generate_content_async(contents)
+        except google_exceptions.ResourceExhausted as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(get_retry_delay(e, delay))
+            delay *= 2
+
+def cache_key(segment):
+    """Build the cache key of a segment from its audio, prompt and model settings"""
+    key = "\0".join([
+        segment['hash'],
+        segment['prompt'],
+        CACHE_FINGERPRINT,
+    ])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def get_cached_transcripts(segments):
+    """Look up cached transcripts, returning {segment index: text} for hits"""
+    if not CACHE_ENABLED:
+        return {}
+    
+    hits = {}
+    now = time.time()
+    with cache_lock:
         try:
-            # Extract timestamp and text
-            timestamp_part = line[line.find('['): line.find(']') + 1]
-            text = line[line.find(']') + 1:].strip()
-            
-            # Validate text content
-            if not is_valid_text(text, seen_texts, last_text):
-                continue
-            
-            # Convert timestamp to seconds
-            start_time = parse_timestamp(timestamp_part)
-            if start_time is None or start_time in seen_timestamps:
-                continue
-            
-            # Ensure timestamps don't overlap and have minimum gap
-            start_time = max(start_time, last_end_time + 1)  # Add 1 second gap
-            end_time = start_time + 3  # 3 second segments
-            
-            # Format timestamps
-            start_stamp = format_srt_timestamp(start_time)
-            end_stamp = format_srt_timestamp(end_time)
-            
-            # Add entry
-            entries.append(f"{current_entry}\n{start_stamp} --> {end_stamp}\n{text}\n")
-            seen_timestamps.add(start_time)
-            seen_texts.add(text)
-            current_entry += 1
-            last_end_time = end_time
-            last_text = text
-            
+            with shelve.open(CACHE_PATH) as cache:
+                for index, segment in enumerate(segments):
+                    key = cache_key(segment)
+                    entry = cache.get(key)
+                    if entry is not None and entry['expire'] > now:
+                        hits[index] = entry['text']
+                        # Mark the entry as recently used
+                        entry['used'] = now
+                        cache[key] = entry
         except Exception as e:
-            continue
+            # The cache is only an optimization, transcribe everything instead
+            print(f"Error reading transcript cache: {str(e)}")
+            hits = {}
+        
+        cache_stats['hits'] += len(hits)
+        cache_stats['misses'] += len(segments) - len(hits)
+    return hits
+
+def prune_cache(cache, now, max_entries):
+    """Drop expired entries, then the least recently used ones beyond
+    max_entries"""
+    live = []
+    for key in list(cache.keys()):
+        entry = cache[key]
+        if entry['expire'] <= now:
+            del cache[key]
+        else:
+            live.append((entry.get('used', 0), key))
+    
+    live.sort()
+    for _, key in live[:max(0, len(live) - max_entries)]:
+        del cache[key]
+
+def store_cached_transcripts(segments, texts):
+    """Store the transcripts of freshly transcribed segments"""
+    if not CACHE_ENABLED:
+        return
+    
+    now = time.time()
+    with cache_lock:
+        try:
+            with shelve.open(CACHE_PATH) as cache:
+                for segment, text in zip(segments, texts):
+                    # Empty text means the request failed, retry it next time
+                    if text.strip():
+                        cache[cache_key(segment)] = {
+                            'text': text,
+                            'expire': now + CACHE_TTL,
+                            'used': now,
+                        }
+                prune_cache(cache, now, CACHE_MAX_ENTRIES)
+        except Exception as e:
+            # Losing cache entries is harmless, the transcripts are still returned
+            print(f"Error writing transcript cache: {str(e)}")
+
+def remove_segment_file(segment):
+    """Delete the temporary file of a segment"""
+    if segment['temporary'] and os.path.exists(segment['path']):
+        os.remove(segment['path'])
+
+def upload_cache_key(segment):
+    """Build the upload cache key of a segment from its audio and the API key"""
+    return hashlib.sha256(
+        f"{UPLOAD_CACHE_OWNER}\0{segment['hash']}".encode('utf-8')
+    ).hexdigest()
+
+def get_uploaded_file(segment):
+    """Return the file Gemini still holds for this segment's audio, if any"""
+    if not CACHE_ENABLED:
+        return None
+    
+    with upload_cache_lock, shelve.open(UPLOAD_CACHE_PATH) as cache:
+        entry = cache.get(upload_cache_key(segment))
+    if entry is None or entry['expire'] <= time.time():
+        return None
+    
+    try:
+        return genai.get_file(entry['name'])
+    except google_exceptions.GoogleAPICallError:
+        # Gone, or not accessible with this key (403), upload it again
+        return None
+
+def store_uploaded_file(segment, file):
+    """Remember the Gemini file holding this segment's audio"""
+    if not CACHE_ENABLED:
+        return
     
-    return '\n'.join(entries)
+    now = time.time()
+    with upload_cache_lock, shelve.open(UPLOAD_CACHE_PATH) as cache:
+        cache[upload_cache_key(segment)] = {
+            'name': file.name,
+            'expire': now + UPLOAD_TTL,
+            'used': now,
+        }
+        prune_cache(cache, now, UPLOAD_CACHE_MAX_ENTRIES)
+
+def upload_segment(segment):
+    """Upload a segment to Gemini unless it is already there, removing its
+    local file afterwards"""
+    try:
+        file = get_uploaded_file(segment)
+        if file is None:
+            file = genai.upload_file(segment['path'], mime_type=segment['mime_type'])
+            # Overwrites any stale entry left for this segment
+            store_uploaded_file(segment, file)
+        return file
+    finally:
+        remove_segment_file(segment)
+
+async def generate_batch(batch, files, generate_limit):
+    """Transcribe uploaded segments in a single request, returning
+    (text, complete) for each segment. A response that is cut off at the
+    output token limit or whose headers don't match is retried as two smaller
+    batches"""
+    async with generate_limit:
+        response = await generate_with_backoff([*files, get_batch_prompt(batch)])
+    
+    truncated = (
+        response.candidates[0].finish_reason
+        == genai.protos.Candidate.FinishReason.MAX_TOKENS
+    )
+    texts = split_batch_response(response.text, batch)
+    if texts is not None and not truncated:
+        return [(text, True) for text in texts]
+    
+    if len(batch) > 1:
+        middle = len(batch) // 2
+        first, second = await asyncio.gather(
+            generate_batch(batch[:middle], files[:middle], generate_limit),
+            generate_batch(batch[middle:], files[middle:], generate_limit)
+        )
+        return first + second
+    
+    # A single segment that still doesn't fit, keep the partial transcript
+    # but don't treat it as complete
+    return [(texts[0] if texts is not None else response.text, False)]
+
+async def process_batch(batch, uploads, generate_limit):
+    """Transcribe a batch of segments once their uploads finish, returning
+    (text, complete) for each segment"""
+    results = [("", False)] * len(batch)
+    
+    # Wait for every segment of the batch to be uploaded to Gemini, then carry
+    # on with the ones that made it
+    files = await asyncio.gather(*uploads, return_exceptions=True)
+    uploaded = []
+    for position, file in enumerate(files):
+        if isinstance(file, BaseException):
+            print(f"Error uploading segment: {str(file)}")
+        else:
+            uploaded.append(position)
+    if not uploaded:
+        return results
+    
+    try:
+        transcripts = await generate_batch(
+            [batch[position] for position in uploaded],
+            [files[position] for position in uploaded],
+            generate_limit
+        )
+    except Exception as e:
+        print(f"Error processing segments: {str(e)}")
+        return results
+    
+    for position, transcript in zip(uploaded, transcripts):
+        results[position] = transcript
+    return results
+
+async def transcribe_segments(segments):
+    """Transcribe segments, returning the non-empty transcripts in order"""
+    # Reuse cached transcripts, their segment files are no longer needed
+    # Shelve access is blocking disk I/O, keep it off the event loop
+    texts = await asyncio.to_thread(get_cached_transcripts, segments)
+    for index in texts:
+        remove_segment_file(segments[index])
+    
+    pending = [index for index in range(len(segments)) if index not in texts]
+    batches = [
+        pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)
+    ]
+    
+    # Keep the number of requests in flight within the API rate limit
+    upload_limit = asyncio.Semaphore(MAX_WORKERS)
+    generate_limit = asyncio.Semaphore(MAX_WORKERS)
+    
+    async def upload(segment):
+        # The SDK has no async upload, run it in a worker thread
+        async with upload_limit:
+            return await asyncio.to_thread(upload_segment, segment)
+    
+    # Start every upload right away so that later batches upload while earlier
+    # ones generate, gather keeps the batches in their original order
+    uploads = {index: asyncio.create_task(upload(segments[index])) for index in pending}
+    results = await asyncio.gather(*[
+        process_batch(
+            [segments[i] for i in batch],
+            [uploads[i] for i in batch],
+            generate_limit
+        )
+        for batch in batches
+    ])
+    # Only cache transcripts known to be complete
+    complete = []
+    for batch, batch_results in zip(batches, results):
+        for index, (text, is_complete) in zip(batch, batch_results):
+            texts[index] = text
+            if is_complete:
+                complete.append(index)
+    
+    await asyncio.to_thread(
+        store_cached_transcripts,
+        [segments[index] for index in complete],
+        [texts[index] for index in complete]
+    )
+    
+    return [
+        texts[index] for index in range(len(segments)) if texts[index].strip()
+    ]
 
 # Ensure output directory exists
 os.makedirs('output', exist_ok=True)
 
-def transcribe(audio_file):
+async def transcribe(audio_file):
     if audio_file is None:
         return [None, None, "Please upload an audio file."]
     
     try:
-        # Split audio into segments
-        segments = split_audio(audio_file.name)
-        all_transcripts = []
-        
-        # Process each segment
-        for segment in segments:
-            try:
-                # Upload segment to Gemini
-                file = genai.upload_file(segment['path'])
-                
-                # Generate transcript for this segment with safety settings
-                prompt = get_segment_prompt(segment['start_time'])
-                response = model.generate_content(
-                    [file, prompt],
-                    safety_settings=safety_settings
-                )
-                
-                # Add to transcripts list if response has content
-                if response.text.strip():
-                    all_transcripts.append(response.text)
-            except Exception as e:
-                print(f"Error processing segment: {str(e)}")
-            finally:
-                # Clean up segment file
-                if os.path.exists(segment['path']):
-                    os.remove(segment['path'])
+        # Split audio into segments in a scratch directory removed afterwards
+        segment_root = await asyncio.to_thread(get_segment_dir, audio_file.name)
+        with tempfile.TemporaryDirectory(prefix='segments_', dir=segment_root) as segment_dir:
+            segments = await asyncio.to_thread(split_audio, audio_file.name, segment_dir)
+            all_transcripts = await transcribe_segments(segments)
         
         # Combine all transcripts
         transcript = "\n".join(all_transcripts)
         
-        # Create both plain text and SRT versions
-        srt_content = format_srt(transcript)
-        
-        # Save both versions
+        # Save both plain text and SRT versions
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         txt_path = os.path.join('output', f"transcript_{timestamp}.txt")
         srt_path = os.path.join('output', f"transcript_{timestamp}.srt")
@@ -239,7 +666,7 @@ def transcribe(audio_file):
         with open(txt_path, "w", encoding="utf-8") as f:
             f.write(transcript)
         with open(srt_path, "w", encoding="utf-8") as f:
-            f.write(srt_content)
+            f.writelines(format_srt_iter(transcript))
         
         return [txt_path, srt_path, transcript]
     